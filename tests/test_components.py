@@ -1,8 +1,12 @@
 import pytest
 import abc
+import copy
+import functools
 import os
+import pickle
+import re
 import sys
-from glob import glob
+from collections.abc import Mapping
 import xarray as xr
 import numpy as np
 import logging
@@ -24,52 +28,64 @@ from sympl._core.tracers import reset_tracers, reset_packers
 from datetime import datetime, timedelta
 os.environ['NUMBA_DISABLE_JIT'] = '1'
 
-vertical_dimension_names = [
-    'interface_levels', 'mid_levels', 'full_levels']
-
 cache_folder = os.path.join(
     os.path.dirname(os.path.realpath(__file__)), 'cached_component_output')
 
 
+@functools.lru_cache(maxsize=1)
+def _cache_index():
+    index = {}
+    for filename in os.listdir(cache_folder):
+        match = re.match(r'^(\w+)-(\w+)-(\d+)\.cache$', filename)
+        if match is not None:
+            index.setdefault(match.group(1, 2), []).append(
+                (int(match.group(3)), os.path.join(cache_folder, filename)))
+    return {
+        key: [filename for _, filename in sorted(value)]
+        for key, value in index.items()}
+
+
 def cache_dictionary(dictionary, filename):
-    dataset = xr.Dataset(dictionary)
-    dataset.to_netcdf(filename, engine='scipy')
+    cache = {}
+    for name, value in dictionary.items():
+        if not isinstance(value, xr.DataArray):
+            value = DataArray(value)
+        cache[name] = (value.values, value.dims, dict(value.attrs))
+    with open(filename, 'wb') as f:
+        pickle.dump(cache, f, protocol=4)
 
 
 def load_dictionary(filename):
-    dataset = xr.open_dataset(filename, engine='scipy')
-    return_dict = dict(dataset.data_vars)
-    return_dict.update(dataset.coords)
-    return return_dict
+    with open(filename, 'rb') as f:
+        cache = pickle.load(f)
+    return {
+        name: DataArray(values, dims=dims, attrs=attrs)
+        for name, (values, dims, attrs) in cache.items()}
 
 
-def state_3d_to_1d(state):
-    return_state = {}
-    for name, value in state.items():
-        if name == 'time':
-            return_state[name] = value
-        else:
-            dim_list = []
-            for i, dim in enumerate(value.dims):
-                if dim in vertical_dimension_names:
-                    dim_list.append(slice(0, value.shape[i]))
-                else:
-                    dim_list.append(0)
-            return_state[name] = value[tuple(dim_list)]
-    return return_state
-
-
-def transpose_state(state, dims=None):
-    return_state = {}
-    for name, value in state.items():
-        if name == 'time':
-            return_state[name] = state[name]
-        else:
-            if dims is None:
-                return_state[name] = state[name].transpose()
-            else:
-                return_state[name] = state[name].transpose(*dims)
-    return return_state
+class LazyDictionary(Mapping):
+    """Read-only view of a cached dictionary, loaded on first access."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._dictionary = None
+
+    def _load(self):
+        if self._dictionary is None:
+            self._dictionary = load_dictionary(self.filename)
+        return self._dictionary
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self.filename)
 
 
 def call_with_timestep_if_needed(
@@ -81,6 +97,13 @@ def call_with_timestep_if_needed(
         return component(state)
 
 
+def get_cloudy_state(component, grid_state, cloud_levels):
+    state = climt.get_default_state([component], grid_state=grid_state)
+    state['cloud_area_fraction_in_atmosphere_layer'][cloud_levels] = 0.5
+    state['mass_content_of_cloud_ice_in_atmosphere_layer'][cloud_levels] = 0.3
+    return state
+
+
 class ComponentBase(object):
 
     def setUp(self):
@@ -88,6 +111,18 @@ class ComponentBase(object):
         reset_packers()
         super(ComponentBase, self).setUp()
 
+    @pytest.fixture(scope='class', autouse=True)
+    @classmethod
+    def class_cache_scope(cls, request):
+        # input states and cached outputs are memoized on the test class so
+        # they are shared by its test methods; drop them once the class is done
+        yield
+        for name in (
+                '_cached_1d_input_state', '_cached_3d_input_state',
+                '_cached_outputs'):
+            if name in request.cls.__dict__:
+                delattr(request.cls, name)
+
     @abc.abstractmethod
     def get_component_instance(self):
         pass
@@ -96,14 +131,20 @@ class ComponentBase(object):
         return '{}-{}-{}.cache'.format(self.__class__.__name__, descriptor, i)
 
     def get_cached_output(self, descriptor):
-        cache_filename_list = sorted(glob(
-            os.path.join(
-                cache_folder,
-                self.get_cache_filename(descriptor, '*'))))
+        cached_outputs = self.__class__.__dict__.get('_cached_outputs')
+        if cached_outputs is None:
+            cached_outputs = {}
+            self.__class__._cached_outputs = cached_outputs
+        if descriptor not in cached_outputs:
+            cached_outputs[descriptor] = self.load_cached_output(descriptor)
+        return cached_outputs[descriptor]
+
+    def load_cached_output(self, descriptor):
+        cache_filename_list = _cache_index().get(
+            (self.__class__.__name__, descriptor), [])
         if len(cache_filename_list) > 0:
-            return_list = []
-            for filename in cache_filename_list:
-                return_list.append(load_dictionary(filename))
+            return_list = [
+                LazyDictionary(filename) for filename in cache_filename_list]
             if len(return_list) > 1:
                 return tuple(return_list)
             elif len(return_list) == 1:
@@ -118,27 +159,33 @@ class ComponentBase(object):
             cache_filename = os.path.join(
                 cache_folder, self.get_cache_filename(descriptor, i))
             cache_dictionary(output[i], cache_filename)
+        _cache_index.cache_clear()
+        self.__class__.__dict__.get('_cached_outputs', {}).pop(descriptor, None)
 
     def assert_valid_output(self, output):
         if isinstance(output, dict):
             output = [output]
         for i, out_dict in enumerate(output):
             for name, value in out_dict.items():
-                try:
-                    if name != 'time' and np.any(np.isnan(value)):
-                        raise AssertionError(
-                            'NaN produced in output {} from dict {}'.format(name, i))
-                except TypeError:  # raised if cannot run isnan on dtype of value
-                    pass
+                if name == 'time':
+                    continue
+                # only float, complex, datetime and timedelta dtypes can hold NaN/NaT
+                if value.dtype.kind in 'fcmM' and np.any(np.isnan(value.values)):
+                    raise AssertionError(
+                        'NaN produced in output {} from dict {}'.format(name, i))
 
 
 class ComponentBaseColumn(ComponentBase):
 
     def get_1d_input_state(self, component=None):
-        if component is None:
-            component = self.get_component_instance()
-        return climt.get_default_state(
-            [component], grid_state=get_grid(nx=None, ny=None, nz=30))
+        if component is not None:
+            return climt.get_default_state(
+                [component], grid_state=get_grid(nx=None, ny=None, nz=30))
+        if '_cached_1d_input_state' not in self.__class__.__dict__:
+            self.__class__._cached_1d_input_state = climt.get_default_state(
+                [self.get_component_instance()],
+                grid_state=get_grid(nx=None, ny=None, nz=30))
+        return copy.deepcopy(self.__class__._cached_1d_input_state)
 
     def test_column_output_matches_cached_output(self):
         state = self.get_1d_input_state()
@@ -175,12 +222,18 @@ class ComponentBaseColumn(ComponentBase):
 
 class ComponentBase3D(ComponentBase):
 
-    def get_3d_input_state(self, component=None):
-        if component is None:
-            component = self.get_component_instance()
+    def build_3d_input_state(self, component):
         return climt.get_default_state(
             [component], grid_state=get_grid(nx=32, ny=16, nz=28))
 
+    def get_3d_input_state(self, component=None):
+        if component is not None:
+            return self.build_3d_input_state(component)
+        if '_cached_3d_input_state' not in self.__class__.__dict__:
+            self.__class__._cached_3d_input_state = self.build_3d_input_state(
+                self.get_component_instance())
+        return copy.deepcopy(self.__class__._cached_3d_input_state)
+
     def test_3d_output_matches_cached_output(self):
         state = self.get_3d_input_state()
         component = self.get_component_instance()
@@ -252,6 +305,9 @@ class ComponentBase3D(ComponentBase):
 
 def compare_outputs(current, cached):
     if isinstance(current, tuple) and isinstance(cached, tuple):
+        if len(current) != len(cached):
+            raise AssertionError(
+                'Different number of dicts returned than cached.')
         for i in range(len(current)):
             compare_one_state_pair(current[i], cached[i])
     elif (not isinstance(current, tuple)) and (not isinstance(cached, tuple)):
@@ -261,22 +317,37 @@ def compare_outputs(current, cached):
 
 
 def compare_one_state_pair(current, cached):
+    current_keys = set(current)
+    cached_keys = set(cached)
+    if current_keys != cached_keys:
+        raise AssertionError(
+            'Output keys differ from cached keys; missing from output: {}, '
+            'not in cached output: {}'.format(
+                sorted(cached_keys - current_keys),
+                sorted(current_keys - cached_keys)))
     for key in current.keys():
         if key == 'time':
-            assert key in cached.keys()
-        else:
-            try:
-                if not np.all(current[key] == cached[key]):
-                    assert np.all(np.isclose(current[key] - cached[key], 0.))
-                for attr in current[key].attrs:
-                    assert current[key].attrs[attr] == cached[key].attrs[attr]
-                for attr in cached[key].attrs:
-                    assert attr in current[key].attrs
-                assert set(current[key].dims) == set(cached[key].dims)
-            except AssertionError as err:
-                raise AssertionError('Error for {}: {}'.format(key, err))
-    for key in cached.keys():
-        assert key in current.keys()
+            continue
+        try:
+            current_value = current[key]
+            cached_value = cached[key]
+            if set(current_value.dims) != set(cached_value.dims):
+                raise AssertionError('dims mismatch {} vs {}'.format(
+                    current_value.dims, cached_value.dims))
+            current_value = current_value.transpose(*cached_value.dims)
+            if current_value.shape != cached_value.shape:
+                raise AssertionError('shape mismatch {} vs {} for dims {}'.format(
+                    current_value.shape, cached_value.shape, cached_value.dims))
+            if not np.array_equal(current_value.values, cached_value.values):
+                # assert_allclose treats matching NaNs as equal; they must not pass
+                if current_value.isnull().any() or cached_value.isnull().any():
+                    raise AssertionError('NaN in current or cached values')
+                xr.testing.assert_allclose(
+                    current_value.variable, cached_value.variable,
+                    rtol=0., atol=1e-8)
+            assert current_value.attrs == cached_value.attrs
+        except AssertionError as err:
+            raise AssertionError('Error for {}: {}'.format(key, err))
 
 
 class TestHeldSuarez(ComponentBase3D, ComponentBaseColumn):
@@ -349,14 +420,9 @@ class TestRRTMGLongwaveMCICA(ComponentBaseColumn, ComponentBase3D):
     def get_component_instance(self):
         return RRTMGLongwave(mcica=True)
 
-    def get_3d_input_state(self, component=None):
-        if component is None:
-            component = self.get_component_instance()
-        state = climt.get_default_state([component],
-                                        grid_state=climt.get_grid(nx=10, ny=5))
-        state['cloud_area_fraction_in_atmosphere_layer'][16:19] = 0.5
-        state['mass_content_of_cloud_ice_in_atmosphere_layer'][16:19] = 0.3
-        return state
+    def build_3d_input_state(self, component):
+        return get_cloudy_state(
+            component, climt.get_grid(nx=10, ny=5), slice(16, 19))
 
     def test_rrtmg_logging(self, caplog):
         caplog.set_level(logging.INFO)
@@ -394,14 +460,9 @@ class TestRRTMGShortwaveMCICA(ComponentBaseColumn, ComponentBase3D):
     def get_component_instance(self):
         return RRTMGShortwave(mcica=True)
 
-    def get_3d_input_state(self, component=None):
-        if component is None:
-            component = self.get_component_instance()
-        state = climt.get_default_state([component],
-                                        grid_state=climt.get_grid(nx=3, ny=2, nz=15))
-        state['cloud_area_fraction_in_atmosphere_layer'][10:12] = 0.5
-        state['mass_content_of_cloud_ice_in_atmosphere_layer'][10:12] = 0.3
-        return state
+    def build_3d_input_state(self, component):
+        return get_cloudy_state(
+            component, climt.get_grid(nx=3, ny=2, nz=15), slice(10, 12))
 
     def test_transposed_state_gives_same_output(self):
         return
@@ -483,8 +544,8 @@ class TestIceSheetLand(ComponentBaseColumn, ComponentBase3D):
         ice = IceSheet()
         return ice
 
-    def get_3d_input_state(self):
-        state = super(TestIceSheetLand, self).get_3d_input_state()
+    def build_3d_input_state(self, component):
+        state = super(TestIceSheetLand, self).build_3d_input_state(component)
 
         state['area_type'].values[:] = 'land'
         state['surface_snow_thickness'].values[:] = 3